@@ -24,6 +24,312 @@ handler.setFormatter(formatter)
 handler.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
+# columns of the ES table that store the global percentile values of each layer
+PERCENTILE_COLS = [str(q) for q in range(101)]
+# number of bits of the pixel values that are resolved in each pass
+RADIX_BITS = 16
+
+
+def _valid_block_values(band, offset, nodata):
+    """Read a block of a raster band and return its valid values as a 1D array.
+
+    Args:
+        band (gdal.Band): raster band to read from
+        offset (dict): block offset dict as yielded by
+            ``pygeoprocessing.iterblocks(..., offset_only=True)``
+        nodata (number): nodata value of the band, or None
+
+    Returns:
+        1D numpy array of the non-nodata, finite values in the block
+    """
+    array = band.ReadAsArray(**offset)
+    valid_mask = numpy.ones(array.shape, dtype=bool)
+    if numpy.issubdtype(array.dtype, numpy.floating):
+        valid_mask &= numpy.isfinite(array)
+        if nodata is not None:
+            valid_mask &= ~numpy.isclose(array, nodata, equal_nan=True)
+    elif nodata is not None:
+        valid_mask &= array != nodata
+    return array[valid_mask]
+
+
+def _ordered_keys(values):
+    """Map values to unsigned integer keys that sort in the same order.
+
+    The keys have as many bits as the values' data type. Float values are
+    mapped through their IEEE 754 bit pattern, with the sign bit flipped for
+    positive values and all bits flipped for negative values.
+
+    Args:
+        values (numpy.ndarray): integer or float values
+
+    Returns:
+        uint64 numpy array of keys
+    """
+    n_bits = values.dtype.itemsize * 8
+    sign_bit = numpy.uint64(1 << (n_bits - 1))
+    mask = numpy.uint64((1 << n_bits) - 1)
+    if numpy.issubdtype(values.dtype, numpy.floating):
+        bits = values.view(f'u{values.dtype.itemsize}').astype(numpy.uint64)
+        return numpy.where(bits & sign_bit, ~bits & mask, bits | sign_bit)
+    if numpy.issubdtype(values.dtype, numpy.signedinteger):
+        return (values.astype(numpy.int64).view(numpy.uint64) & mask) ^ sign_bit
+    return values.astype(numpy.uint64)
+
+
+def _keys_to_values(keys, dtype):
+    """Invert ``_ordered_keys``.
+
+    Args:
+        keys (numpy.ndarray): uint64 keys from ``_ordered_keys``
+        dtype (numpy.dtype): data type of the original values
+
+    Returns:
+        numpy array of the original values, of type ``dtype``
+    """
+    n_bits = dtype.itemsize * 8
+    sign_bit = numpy.uint64(1 << (n_bits - 1))
+    mask = numpy.uint64((1 << n_bits) - 1)
+    unsigned_type = f'u{dtype.itemsize}'
+    if numpy.issubdtype(dtype, numpy.floating):
+        bits = numpy.where(keys & sign_bit, keys ^ sign_bit, ~keys & mask)
+        return bits.astype(unsigned_type).view(dtype)
+    if numpy.issubdtype(dtype, numpy.signedinteger):
+        return (keys ^ sign_bit).astype(unsigned_type).view(dtype)
+    return keys.astype(dtype)
+
+
+def _histogram_blocks(raster_path, offset_list, prefixes, prefix_bits, digit_bits):
+    """Count the values in a set of raster blocks by their next digit.
+
+    Each value's key (see ``_ordered_keys``) is split into a prefix of its
+    ``prefix_bits`` highest bits, followed by a digit of the next
+    ``digit_bits`` bits. Only values whose prefix is one of ``prefixes`` are
+    counted. The counts of different sets of blocks can be merged by summing.
+
+    Args:
+        raster_path (str): path to a single-band GDAL-supported raster
+        offset_list (list[dict]): block offsets to read from the raster
+        prefixes (numpy.ndarray): sorted uint64 key prefixes to count
+        prefix_bits (int): number of bits in each prefix
+        digit_bits (int): number of bits in the digit to count
+
+    Returns:
+        tuple of (flat indices, counts) of the nonzero cells of the
+        ``(len(prefixes), 2**digit_bits)`` histogram of prefixes by digit
+    """
+    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    band = raster.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+
+    counts = numpy.zeros(prefixes.size * 2**digit_bits, dtype=numpy.int64)
+    for offset in offset_list:
+        values = _valid_block_values(band, offset, nodata)
+        if values.size == 0:
+            continue
+        keys = _ordered_keys(values)
+        n_bits = values.dtype.itemsize * 8
+        digits = (
+            (keys >> numpy.uint64(n_bits - prefix_bits - digit_bits)) &
+            numpy.uint64(2**digit_bits - 1)).astype(numpy.int64)
+        if prefix_bits == 0:
+            rows = numpy.zeros(keys.size, dtype=numpy.int64)
+        else:
+            key_prefixes = keys >> numpy.uint64(n_bits - prefix_bits)
+            rows = numpy.clip(
+                numpy.searchsorted(prefixes, key_prefixes), 0, prefixes.size - 1)
+            target_mask = prefixes[rows] == key_prefixes
+            rows, digits = rows[target_mask], digits[target_mask]
+        bins, bin_counts = numpy.unique(
+            rows * 2**digit_bits + digits, return_counts=True)
+        counts[bins] += bin_counts
+
+    band = None
+    raster = None
+
+    nonzero_bins = numpy.flatnonzero(counts)
+    return nonzero_bins, counts[nonzero_bins]
+
+
+def _percentile_indices(count):
+    """Find the 0-based index, in sorted order, of the value at each percentile.
+
+    The q-th percentile is the smallest value such that at least q% of the
+    values are less than or equal to it (as in
+    ``numpy.percentile(..., method='inverted_cdf')``, but in integer
+    arithmetic so that it is not subject to floating point rounding).
+
+    Args:
+        count (int): total number of values
+
+    Returns:
+        int64 numpy array of length 101
+    """
+    return numpy.maximum(
+        (numpy.arange(101, dtype=numpy.int64) * count + 99) // 100 - 1, 0)
+
+
+def _percentile_rank(values, percentiles):
+    """Find the global percentile rank of each value.
+
+    Args:
+        values (numpy.ndarray): values to rank
+        percentiles (numpy.ndarray): the 0-100 percentile values of the layer
+
+    Returns:
+        float array of the highest percentile (0-100) that each value is
+        greater than or equal to. NaN where the value is NaN.
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    ranks = numpy.full(values.shape, numpy.nan)
+    if numpy.isnan(percentiles).any():
+        return ranks
+    valid_mask = ~numpy.isnan(values)
+    ranks[valid_mask] = numpy.clip(
+        numpy.searchsorted(percentiles, values[valid_mask], side='right') - 1,
+        0, 100)
+    return ranks
+
+
+def _get_percentiles(row):
+    """Get the percentile values from a row of the ES table, if present.
+
+    Args:
+        row (pd.Series): row of the ES table
+
+    Returns:
+        numpy array of the 0-100 percentile values, or None if the ES table
+        does not have percentile columns
+    """
+    if not set(PERCENTILE_COLS).issubset(row.index):
+        return None
+    return row[PERCENTILE_COLS].to_numpy(dtype=numpy.float64)
+
+
+def calculate_es_percentiles(es_table_path, id_col='es_id', n_workers=-1):
+    """Calculate the global percentiles of each ES layer.
+
+    Each raster is read block by block, so it never has to fit in memory.
+    The percentiles are found by a radix selection on the bits of the pixel
+    values: each pass reads the raster and counts the next ``RADIX_BITS``
+    bits of the values, but only among the values that share the already
+    resolved bits of some percentile. Layers are read once per 16 bits of
+    their data type (once for 8- and 16-bit layers, twice for 32-bit layers).
+
+    In each pass, the blocks are split into one chunk per worker and the
+    chunks' counts are summed. With ``n_workers`` of 0 or -1 there is a
+    single chunk, read serially; set ``n_workers`` > 0 to read the chunks in
+    parallel.
+
+    The percentile values are written to the ES table in columns named
+    ``0`` through ``100``, replacing any existing percentile values. They are
+    exact: the q-th percentile is the smallest pixel value such that at least
+    q% of the valid pixels are less than or equal to it.
+
+    Args:
+        es_table_path (str): path to the ecosystem service CSV
+        id_col (str): name of the column of unique ES identifiers
+        n_workers (int): number of parallel subprocess workers to use
+
+    Returns:
+        None
+    """
+    logger.info('calculating global percentiles of ecosystem service layers...')
+    n_workers = int(n_workers)
+    graph = taskgraph.TaskGraph(os.getcwd(), n_workers=n_workers)
+
+    es_df = pd.read_csv(es_table_path)
+    es_id_to_state = {}
+    for _, row in es_df.iterrows():
+        es_id = row[id_col]
+        path = os.path.abspath(os.path.join(
+            os.path.dirname(es_table_path), row['es_value_path']))
+
+        # split the blocks among the workers, one chunk per worker
+        offsets = list(pygeoprocessing.iterblocks((path, 1), offset_only=True))
+        n_chunks = max(min(n_workers, len(offsets)), 1)
+        es_id_to_state[es_id] = {
+            'path': path,
+            'dtype': numpy.dtype(pygeoprocessing.get_raster_info(path)['numpy_type']),
+            'chunks': [offsets[i::n_chunks] for i in range(n_chunks)],
+            # key prefixes that need to be refined in the next pass
+            'prefixes': numpy.zeros(1, dtype=numpy.uint64),
+            'prefix_bits': 0,
+            # for each percentile, the resolved prefix of its key and its
+            # index in sorted order among the values that share that prefix
+            'percentile_prefixes': numpy.zeros(101, dtype=numpy.uint64),
+            'percentile_indices': None}
+
+    es_id_to_percentiles = {}
+    n_pass = 0
+    while len(es_id_to_percentiles) < len(es_id_to_state):
+        es_id_to_tasks = {}
+        for es_id, state in es_id_to_state.items():
+            if es_id in es_id_to_percentiles:
+                continue
+            state['digit_bits'] = min(
+                RADIX_BITS, state['dtype'].itemsize * 8 - state['prefix_bits'])
+            es_id_to_tasks[es_id] = [
+                graph.add_task(
+                    func=_histogram_blocks,
+                    args=(state['path'], chunk, state['prefixes'],
+                          state['prefix_bits'], state['digit_bits']),
+                    target_path_list=[],
+                    task_name=f'{es_id} histogram pass {n_pass} chunk {i}',
+                    store_result=True)
+                for i, chunk in enumerate(state['chunks'])]
+        graph.join()
+
+        for es_id, tasks in es_id_to_tasks.items():
+            state = es_id_to_state[es_id]
+            n_digits = 2**state['digit_bits']
+            chunk_counts = [task.get() for task in tasks]
+            counts = numpy.bincount(
+                numpy.concatenate([bins for bins, _ in chunk_counts]),
+                weights=numpy.concatenate([counts for _, counts in chunk_counts]),
+                minlength=state['prefixes'].size * n_digits
+            ).astype(numpy.int64).reshape((state['prefixes'].size, n_digits))
+
+            if state['percentile_indices'] is None:
+                if counts.sum() == 0:
+                    logger.warning(f'{es_id} has no valid pixels')
+                    es_id_to_percentiles[es_id] = numpy.full(101, numpy.nan)
+                    continue
+                state['percentile_indices'] = _percentile_indices(counts.sum())
+
+            # find the digit that holds each percentile within its prefix
+            rows = numpy.searchsorted(
+                state['prefixes'], state['percentile_prefixes'])
+            cumulative_counts = numpy.cumsum(counts, axis=1)
+            digits = numpy.array([
+                numpy.searchsorted(cumulative_counts[row], index, side='right')
+                for row, index in zip(rows, state['percentile_indices'])])
+            state['percentile_indices'] -= (
+                cumulative_counts[rows, digits] - counts[rows, digits])
+            state['percentile_prefixes'] = (
+                (state['percentile_prefixes'] << numpy.uint64(state['digit_bits'])) |
+                digits.astype(numpy.uint64))
+            state['prefix_bits'] += state['digit_bits']
+
+            if state['prefix_bits'] == state['dtype'].itemsize * 8:
+                es_id_to_percentiles[es_id] = _keys_to_values(
+                    state['percentile_prefixes'], state['dtype']
+                ).astype(numpy.float64)
+            else:
+                state['prefixes'] = numpy.unique(state['percentile_prefixes'])
+        n_pass += 1
+
+    graph.close()
+    graph.join()
+
+    percentile_df = pd.DataFrame(
+        [es_id_to_percentiles[es_id] for es_id in es_df[id_col]],
+        columns=PERCENTILE_COLS, index=es_df.index)
+    es_df = pd.concat(
+        [es_df.drop(columns=PERCENTILE_COLS, errors='ignore'), percentile_df],
+        axis=1)
+    es_df.to_csv(es_table_path, index=False)
+
 
 def buffer_points(point_vector_path, buffer_csv_path, attr, area_col='footprint_area'):
     """Buffer points according to a given attribute.
@@ -77,6 +383,10 @@ def buffer_points(point_vector_path, buffer_csv_path, attr, area_col='footprint_
 def point_stats(point_path, es_table_path, id_col='es_id'):
     """Find and record ecosystem service values under points.
 
+    If the ES table has percentile columns 0 through 100 (see
+    ``calculate_es_percentiles``), the percentile rank of each point value
+    is recorded.
+
     Args:
         point_gdf (gpd.GeoDataframe):
         out_path (str):
@@ -101,7 +411,8 @@ def point_stats(point_path, es_table_path, id_col='es_id'):
         )
     ]
     
-    for _, row in pd.read_csv(es_table_path).iterrows():
+    # read percentile values exactly so that pixel values rank consistently
+    for _, row in pd.read_csv(es_table_path, float_precision='round_trip').iterrows():
         es_id = row[id_col]
         # evaluate path relative to the ES table location
         es_path = os.path.abspath(os.path.join(
@@ -120,6 +431,12 @@ def point_stats(point_path, es_table_path, id_col='es_id'):
         point_gdf[es_id] = point_values
         point_gdf[f'{es_id}_flag'] = point_values > row['flag_threshold']
 
+        # rank each value against the global percentiles, if known
+        percentiles = _get_percentiles(row)
+        if percentiles is not None:
+            point_gdf[f'{es_id}_percentile'] = _percentile_rank(
+                point_values, percentiles)
+
     return point_gdf
 
 
@@ -131,8 +448,10 @@ def footprint_stats(footprint_path, es_table_path, id_col='es_id', n_workers=-1)
         es_table_path (str): path to the ecosystem service CSV, which should
             have the following columns: es_id (the unique identifier for
             each ecosystem service); path (the path to the global ecosystem
-            service raster); and the numbers 0 through 100, storing the
-            integer percentile values for each ecosystem service globally.
+            service raster); and optionally the numbers 0 through 100, storing
+            the percentile values for each ecosystem service globally (see
+            ``calculate_es_percentiles``). If present, the percentile rank of
+            each footprint's max value is recorded.
         out_path (str): path to write out the resulting footprint stats vector
 
     Returns:
@@ -148,7 +467,8 @@ def footprint_stats(footprint_path, es_table_path, id_col='es_id', n_workers=-1)
             (footprint_gdf.geom_type == 'MultiPolygon')).all():
         raise ValueError('All geometries in the asset vector must be polygons or multipolygons')
 
-    es_df = pd.read_csv(es_table_path)
+    # read percentile values exactly so that pixel values rank consistently
+    es_df = pd.read_csv(es_table_path, float_precision='round_trip')
     es_id_to_task = {}
     for i, row in es_df.iterrows():
         es_id = row[id_col]
@@ -188,6 +508,13 @@ def footprint_stats(footprint_path, es_table_path, id_col='es_id', n_workers=-1)
         footprint_gdf[f'{es_id}_adj_sum'] = (
             footprint_gdf[f'{es_id}_mean'] * footprint_gdf.area / row['pixel_area'])
 
+        # rank the max value against the global percentiles, if known
+        percentiles = _get_percentiles(row)
+        if percentiles is not None:
+            footprint_gdf[f'{es_id}_max_percentile'] = _percentile_rank(
+                footprint_gdf[f'{es_id}_max'].to_numpy(dtype=numpy.float64),
+                percentiles)
+
     return footprint_gdf
 
 
@@ -299,6 +626,10 @@ def execute(args):
     if args.buffer_table and args.mode == 'polygons':
         raise ValueError('Cannot use a buffer table in polygon mode')
 
+    if args.calculate_percentiles:
+        calculate_es_percentiles(
+            args.ecosystem_service_table, n_workers=args.n_workers)
+
     if args.mode == 'points':
         if args.buffer_table:
             footprint_gdf = buffer_points(args.asset_vector, args.buffer_table, attr, 'area')
@@ -337,6 +668,10 @@ def main():
                         help='path to write out the asset results vector')
     parser.add_argument('company_results_path',
                         help='path to write out the aggregated results table')
+    parser.add_argument('-p', '--calculate-percentiles', action='store_true',
+                        help='calculate the global percentiles of each ecosystem '
+                             'service layer and write them to the ecosystem '
+                             'service table. use -n to parallelize.')
     parser.add_argument('-n', '--n-workers', default=-1,
                         help='number of parallel subprocess workers to use. '
                              '0 = no subprocesses.  Set >0 '
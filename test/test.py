@@ -82,6 +82,7 @@ class FootprintImpactWorkflowTests(unittest.TestCase):
         namespace.asset_vector = asset_points_path
         namespace.footprint_results_path = asset_results_path
         namespace.company_results_path = company_results_path
+        namespace.calculate_percentiles = False
         execute(namespace)
 
         actual_asset_gdf = geopandas.read_file(asset_results_path)
@@ -148,6 +149,7 @@ class FootprintImpactWorkflowTests(unittest.TestCase):
         namespace.asset_vector = asset_points_path
         namespace.footprint_results_path = asset_results_path
         namespace.company_results_path = company_results_path
+        namespace.calculate_percentiles = False
         namespace.n_workers = -1
         execute(namespace)
 
@@ -260,6 +262,7 @@ class FootprintImpactWorkflowTests(unittest.TestCase):
         namespace.asset_vector = asset_polygons_path
         namespace.footprint_results_path = asset_results_path
         namespace.company_results_path = company_results_path
+        namespace.calculate_percentiles = False
         namespace.n_workers = -1
         execute(namespace)
 
@@ -302,3 +305,163 @@ class FootprintImpactWorkflowTests(unittest.TestCase):
             'percent_total_flagged': [0.0, 100.0]
         })
         pandas.testing.assert_frame_equal(actual_company_df, expected_company_df)
+
+    def exact_percentiles(self, values):
+        """Calculate the q-th percentiles as the ceil(q% * n)-th smallest value."""
+        sorted_values = numpy.sort(values)
+        indices = (numpy.arange(101) * sorted_values.size + 99) // 100 - 1
+        return sorted_values[numpy.maximum(indices, 0)]
+
+    def test_calculate_es_percentiles(self):
+        from impact.src import calculate_es_percentiles, point_stats
+
+        self.make_es_inputs()
+        calculate_es_percentiles(self.es_table_path, n_workers=-1)
+
+        es_df = pandas.read_csv(self.es_table_path, float_precision='round_trip')
+        percentile_cols = [str(q) for q in range(101)]
+        numpy.testing.assert_array_equal(
+            es_df.loc[0, percentile_cols].to_numpy(dtype=float),
+            self.exact_percentiles(numpy.arange(100)))
+        numpy.testing.assert_array_equal(
+            es_df.loc[1, percentile_cols].to_numpy(dtype=float),
+            self.exact_percentiles(numpy.repeat([0, 1, 1.5, 2, 2.5, 3], 10)))
+
+        asset_points_path = os.path.join(self.workspace_dir, 'assets.geojson')
+        asset_points = [Point(5.55, -4.51), Point(12.9, -12.9), Point(6.09, -20.06)]
+        pygeoprocessing.shapely_geometry_to_vector(
+            asset_points,
+            asset_points_path,
+            self.wkt,
+            'GeoJSON',
+            ogr_geom_type=ogr.wkbPoint)
+
+        point_gdf = point_stats(asset_points_path, self.es_table_path)
+        numpy.testing.assert_array_equal(
+            point_gdf['es_1_percentile'], [12, 56, 93])
+        numpy.testing.assert_array_equal(
+            point_gdf['es_2_percentile'], [numpy.nan, 83, numpy.nan])
+
+    def test_calculate_es_percentiles_distributions(self):
+        from impact.src import calculate_es_percentiles, _percentile_rank
+
+        # layers large enough to be split into several blocks
+        rng = numpy.random.default_rng(0)
+        # heavily right-skewed, with some zeros and negatives
+        skewed_array = rng.lognormal(0, 3, (600, 600)).astype(numpy.float32)
+        skewed_array *= rng.choice([-1, 0, 1], skewed_array.shape, p=[.05, .05, .9])
+        skewed_array[100, 100] = 1e7
+        # a narrow range that is far from zero
+        narrow_array = rng.uniform(1000, 1001, (600, 600)).astype(numpy.float32)
+        # integers close to a nodata value of -2**31
+        int_array = rng.integers(-2**31 + 1, -2**31 + 1000, (600, 600)).astype(numpy.int32)
+        int_array[::7] = rng.integers(0, 2**31 - 1, (600,))
+
+        layers = {
+            'es_skewed': (skewed_array, -1),
+            'es_narrow': (narrow_array, -1),
+            'es_int': (int_array, -2**31)}
+        es_paths = []
+        for es_id, (es_array, nodata) in layers.items():
+            es_array[:10] = nodata
+            es_path = os.path.join(self.workspace_dir, f'{es_id}.tif')
+            pygeoprocessing.numpy_array_to_raster(
+                es_array, nodata, (2, -2), (2, -2), self.wkt, es_path)
+            self.assertGreater(len(list(pygeoprocessing.iterblocks(
+                (es_path, 1), offset_only=True))), 2)
+            es_paths.append(es_path)
+
+        es_table_paths = []
+        for n_workers in [-1, 2]:
+            es_table_path = os.path.join(
+                self.workspace_dir, f'es_table_{n_workers}.csv')
+            pandas.DataFrame({
+                'es_id': list(layers),
+                'es_value_path': es_paths,
+                'flag_threshold': [10, 10, 10]
+            }).to_csv(es_table_path, index=False)
+            calculate_es_percentiles(es_table_path, n_workers=n_workers)
+            es_table_paths.append(es_table_path)
+
+        # merging counts across chunks gives the same result as one chunk
+        single_chunk_df, multi_chunk_df = [
+            pandas.read_csv(path, float_precision='round_trip')
+            for path in es_table_paths]
+        pandas.testing.assert_frame_equal(single_chunk_df, multi_chunk_df)
+
+        percentile_cols = [str(q) for q in range(101)]
+        for i, (es_id, (es_array, nodata)) in enumerate(layers.items()):
+            actual_percentiles = single_chunk_df.loc[i, percentile_cols].to_numpy(
+                dtype=float)
+            valid_values = es_array[10:].flatten()
+            numpy.testing.assert_array_equal(
+                actual_percentiles, self.exact_percentiles(valid_values))
+
+            # the q-th percentile lies at rank q in the data, as does numpy's
+            sorted_values = numpy.sort(valid_values)
+            for percentiles in [actual_percentiles, numpy.percentile(
+                    valid_values, numpy.arange(101), method='inverted_cdf')]:
+                lower_ranks = numpy.searchsorted(
+                    sorted_values, percentiles, side='left') / sorted_values.size * 100
+                upper_ranks = numpy.searchsorted(
+                    sorted_values, percentiles, side='right') / sorted_values.size * 100
+                self.assertTrue((lower_ranks <= numpy.arange(101) + 0.1).all())
+                self.assertTrue((upper_ranks >= numpy.arange(101) - 0.1).all())
+
+        # without ties, each percentile value ranks at its own percentile
+        narrow_percentiles = single_chunk_df.loc[1, percentile_cols].to_numpy(
+            dtype=float)
+        numpy.testing.assert_array_equal(
+            _percentile_rank(
+                self.exact_percentiles(narrow_array[10:].flatten()),
+                narrow_percentiles),
+            numpy.arange(101))
+
+    def test_complete_run_polygon_mode_with_percentiles(self):
+        from impact.src import execute
+
+        self.make_es_inputs()
+
+        asset_polygons_path = os.path.join(self.workspace_dir, 'assets.geojson')
+        asset_polygons = [
+            Polygon([(4.6, -2.3), (7.8, -5.2), (4.6, -5.2), (4.6, -2.3)]),
+            Polygon([(12.5, -12.5), (13.5, -12.5), (13.5, -13.5), (12.5, -13.5), (12.5, -12.5)]),
+            Polygon([(6.01, -20.01), (6.02, -20.01), (6.01, -20.02), (6.01, -20.01)])]
+        pygeoprocessing.shapely_geometry_to_vector(
+            asset_polygons,
+            asset_polygons_path,
+            self.wkt,
+            'GeoJSON',
+            fields={'company': ogr.OFTString},
+            attribute_list=[
+                {'company': 'A'}, {'company': 'A'}, {'company': 'B'}],
+            ogr_geom_type=ogr.wkbPolygon)
+
+        asset_results_path = os.path.join(self.workspace_dir, 'asset_results.gpkg')
+        company_results_path = os.path.join(self.workspace_dir, 'company_results.csv')
+
+        namespace = argparse.Namespace()
+        namespace.mode = 'polygons'
+        namespace.ecosystem_service_table = self.es_table_path
+        namespace.buffer_table = None
+        namespace.asset_vector = asset_polygons_path
+        namespace.footprint_results_path = asset_results_path
+        namespace.company_results_path = company_results_path
+        namespace.calculate_percentiles = True
+        namespace.n_workers = -1
+        execute(namespace)
+
+        # the percentiles are written into the ES table in place
+        es_df = pandas.read_csv(self.es_table_path)
+        self.assertEqual(
+            list(es_df.columns[-101:]), [str(q) for q in range(101)])
+        self.assertEqual(list(es_df['es_id']), ['es_1', 'es_2'])
+
+        actual_asset_gdf = geopandas.read_file(asset_results_path)
+        numpy.testing.assert_array_equal(
+            actual_asset_gdf['es_1_max'], [12, 55, 92])
+        numpy.testing.assert_array_equal(
+            actual_asset_gdf['es_1_max_percentile'], [13, 56, 93])
+        # the third footprint has no es_2 data, so it has no percentile rank
+        numpy.testing.assert_array_equal(
+            actual_asset_gdf['es_2_max_percentile'], [16, 83, numpy.nan])